@@ -1,16 +1,42 @@
+import asyncio
+import functools
+import logging
 import os
+import re
 from datetime import datetime, timezone
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Set, Tuple
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from bson import ObjectId
+import orjson
+from pymongo import ASCENDING, DESCENDING, TEXT, UpdateMany
+from pymongo.write_concern import WriteConcern
 
-from database import db, create_document, get_documents
+from database import db, create_document, get_documents, insert_document
 from schemas import Email as EmailSchema, Tag as TagSchema, Folder as FolderSchema, Event as EventSchema
 
-app = FastAPI(title="HoloMail API")
+try:
+    from websockets.exceptions import ConnectionClosed
+except ImportError:  # wsproto backend: closed sockets surface as RuntimeError/OSError
+    ConnectionClosed = OSError
+
+logger = logging.getLogger(__name__)
+
+
+def dumps(obj: Any) -> bytes:
+    # orjson handles datetimes natively; anything else (e.g. ObjectId) falls back to str
+    return orjson.dumps(obj, default=str)
+
+
+class MongoJSONResponse(ORJSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+app = FastAPI(title="HoloMail API", default_response_class=MongoJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,57 +51,195 @@ app.add_middleware(
 # Utils
 # ---------------------------
 
-def to_object_id(id_str: str) -> ObjectId:
-    return ObjectId(id_str)
+# Plain word queries go to the text index first; anything else uses the prefix regex
+_TEXT_QUERY_RE = re.compile(r"[\w\s]+")
+
+
+@functools.lru_cache(maxsize=1024)
+def _build_q_filter(q: str) -> Dict[str, Any]:
+    # Case-sensitive anchored prefix on the lowercased shadow fields, so each
+    # clause is an index range scan. Cached because typeahead repeats queries;
+    # callers must not mutate the returned dict.
+    prefix = "^" + re.escape(q.lower())
+    return {
+        "$or": [
+            {"subject_lc": {"$regex": prefix}},
+            {"sender_lc": {"$regex": prefix}},
+            {"preview_lc": {"$regex": prefix}},
+        ]
+    }
+
+
+_OBJECT_ID_RE = re.compile(r"[0-9a-fA-F]{24}")
+
+
+def parse_object_ids(ids: List[str]) -> List[ObjectId]:
+    # Validate every id up front so bad input is rejected before any DB work
+    out = []
+    for i in ids:
+        if not _OBJECT_ID_RE.fullmatch(i):
+            raise HTTPException(status_code=400, detail=f"Invalid id: {i}")
+        out.append(ObjectId(i))
+    return out
 
 
 def serialize_doc(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Documents come fresh from the driver, so rename _id in place rather than copying
     if not doc:
         return doc
-    d = dict(doc)
-    if "_id" in d:
-        d["id"] = str(d.pop("_id"))
-    # Convert datetimes to isoformat strings
-    for k, v in list(d.items()):
-        if isinstance(v, datetime):
-            d[k] = v.isoformat()
-    return d
+    if "_id" in doc:
+        doc["id"] = str(doc.pop("_id"))
+    return doc
+
+
+def serialize_email(doc: Dict[str, Any]) -> Dict[str, Any]:
+    # Fast path for the mailbox hot loop: emails always carry an _id
+    doc["id"] = str(doc.pop("_id"))
+    return doc
 
 
 async def broadcast(event: Dict[str, Any]):
-    removable = []
-    for ws in active_connections:
-        try:
-            await ws.send_json(event)
-        except Exception:
-            removable.append(ws)
-    for ws in removable:
+    if not active_connections:
+        return
+    # Encode once and send to every socket concurrently
+    payload = dumps(event).decode()
+    targets = tuple(active_connections)
+    results = await asyncio.gather(*(ws.send_text(payload) for ws in targets), return_exceptions=True)
+    for ws, res in zip(targets, results):
+        if isinstance(res, Exception):
+            active_connections.discard(ws)
+
+
+# Bulk-update notifications are coalesced into one frame per short window
+BROADCAST_BATCH_MAX = 50
+BROADCAST_BATCH_WINDOW = 0.02  # seconds
+_broadcast_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+_broadcast_task: Optional[asyncio.Task] = None
+
+
+async def _broadcast_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        events = [await _broadcast_queue.get()]
+        deadline = loop.time() + BROADCAST_BATCH_WINDOW
+        while len(events) < BROADCAST_BATCH_MAX:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                events.append(await asyncio.wait_for(_broadcast_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
         try:
-            active_connections.remove(ws)
+            if len(events) == 1:
+                await broadcast(events[0])
+            else:
+                await broadcast({"type": "batch", "events": events})
         except Exception:
-            pass
+            # Keep the worker alive, but don't lose coalesced notifications silently
+            logger.exception("Failed to broadcast %d queued event(s)", len(events))
+
+
+@app.on_event("startup")
+async def start_broadcast_worker():
+    global _broadcast_task
+    _broadcast_task = asyncio.create_task(_broadcast_worker())
+
+
+@app.on_event("shutdown")
+async def stop_broadcast_worker():
+    if _broadcast_task is not None:
+        _broadcast_task.cancel()
+
+
+# ---------------------------
+# Startup: indexes
+# ---------------------------
+@app.on_event("startup")
+async def ensure_indexes():
+    if db is None:
+        return
+    # Like cache_collection_names, never let an unreachable database or a
+    # conflicting index block startup; /test reports the database state
+    try:
+        await _prepare_email_collection()
+    except Exception:
+        logger.exception("Email index/backfill setup failed")
+
+
+async def _prepare_email_collection():
+    # Emails written before the explicit flags existed have no is_deleted field,
+    # which the equality filter and partial index below would never match
+    await db["email"].update_many(
+        {"is_deleted": {"$exists": False}},
+        {"$set": {"is_deleted": False}},
+    )
+    # Default is_archived separately so emails archived before this never lose the flag
+    await db["email"].update_many(
+        {"is_archived": {"$exists": False}},
+        {"$set": {"is_archived": False}},
+    )
+    await db["email"].create_index(
+        [("subject", TEXT), ("sender", TEXT), ("preview", TEXT)],
+        name="email_text",
+    )
+    # Shapes used by list_emails: equality filters first, then the sort key
+    await db["email"].create_index(
+        [("folder", ASCENDING), ("is_deleted", ASCENDING), ("is_read", ASCENDING), ("received_at", DESCENDING), ("_id", DESCENDING)],
+        name="mailbox_list",
+    )
+    await db["email"].create_index(
+        [("tags", ASCENDING), ("received_at", DESCENDING), ("_id", DESCENDING)],
+        name="tag_list",
+    )
+    await db["email"].create_index(
+        [("folder", ASCENDING), ("received_at", DESCENDING), ("_id", DESCENDING)],
+        name="mailbox_live",
+        partialFilterExpression={"is_deleted": False},
+    )
+    # Older emails predate the lowercase shadow fields the prefix search reads
+    await db["email"].update_many(
+        {"subject_lc": {"$exists": False}},
+        [{"$set": {
+            "subject_lc": {"$toLower": "$subject"},
+            "sender_lc": {"$toLower": "$sender"},
+            "preview_lc": {"$toLower": "$preview"},
+        }}],
+    )
+    for field in ("subject_lc", "sender_lc", "preview_lc"):
+        await db["email"].create_index([(field, ASCENDING)], name=field)
 
 
 # ---------------------------
 # WebSocket for realtime notifications
 # ---------------------------
-active_connections: List[WebSocket] = []
+active_connections: Set[WebSocket] = set()
+WS_PING_INTERVAL = 30  # seconds
 
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    active_connections.append(websocket)
+    active_connections.add(websocket)
     try:
         await websocket.send_json({"type": "connected", "message": "Realtime channel ready"})
         while True:
-            # We don't expect messages from client; keep connection alive
-            await websocket.receive_text()
+            # We don't expect messages from client; ping when idle so dead
+            # sockets fail the send and are evicted instead of lingering
+            try:
+                await asyncio.wait_for(websocket.receive_text(), timeout=WS_PING_INTERVAL)
+            except asyncio.TimeoutError:
+                try:
+                    await websocket.send_json({"type": "ping"})
+                except (RuntimeError, OSError, ConnectionClosed):
+                    # Ping to a half-closed socket failed; drop it below
+                    break
     except WebSocketDisconnect:
         pass
+    except Exception:
+        logger.exception("WebSocket handler failed")
     finally:
-        if websocket in active_connections:
-            active_connections.remove(websocket)
+        active_connections.discard(websocket)
 
 
 # ---------------------------
@@ -86,8 +250,24 @@ def read_root():
     return {"message": "HoloMail backend running"}
 
 
+# Collection names for /test, fetched once at startup so health checks skip the admin command
+_collection_names: Optional[Tuple[str, ...]] = None
+
+
+@app.on_event("startup")
+async def cache_collection_names():
+    global _collection_names
+    if db is None:
+        return
+    try:
+        _collection_names = tuple(await db.list_collection_names())
+    except Exception:
+        _collection_names = None
+
+
 @app.get("/test")
-def test_database():
+async def test_database(refresh: bool = Query(False, description="Re-read collection names from the database")):
+    global _collection_names
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -103,8 +283,9 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+                if refresh or _collection_names is None:
+                    _collection_names = tuple(await db.list_collection_names())
+                response["collections"] = list(_collection_names[:10])
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️ Connected but Error: {str(e)[:50]}"
@@ -123,21 +304,22 @@ class SchemaInfo(BaseModel):
     json_schema: Dict[str, Any]
 
 
-@app.get("/schema", response_model=List[SchemaInfo])
-def get_schema():
-    models = [
+# Schemas are fixed for the life of the process, so build and encode them once
+_SCHEMA_CACHE = [
+    {"name": name, "json_schema": model.model_json_schema()}
+    for name, model in (
         ("email", EmailSchema),
         ("tag", TagSchema),
         ("folder", FolderSchema),
         ("event", EventSchema),
-    ]
-    out = []
-    for name, model in models:
-        out.append({
-            "name": name,
-            "json_schema": model.model_json_schema(),
-        })
-    return out
+    )
+]
+_SCHEMA_JSON = dumps(_SCHEMA_CACHE)
+
+
+@app.get("/schema", response_model=None, responses={200: {"model": List[SchemaInfo]}})
+def get_schema():
+    return Response(content=_SCHEMA_JSON, media_type="application/json")
 
 
 # ---------------------------
@@ -154,46 +336,116 @@ class EmailCreate(BaseModel):
     is_read: bool = False
 
 
+# The list view never shows the body or the search-only shadow fields
+_EMAIL_SHADOW_FIELDS = ("subject_lc", "sender_lc", "preview_lc")
+_EMAIL_LIST_PROJECTION = {"body": 0, **{field: 0 for field in _EMAIL_SHADOW_FIELDS}}
+
+
 @app.get("/api/emails")
-def list_emails(
+async def list_emails(
     q: Optional[str] = Query(None, description="Search term"),
     folder: Optional[str] = None,
     tag: Optional[str] = None,
     is_read: Optional[bool] = None,
-    page: int = 1,
-    limit: int = 20,
+    page: int = Query(1, ge=1),
+    limit: int = Query(20, ge=1),
+    before: Optional[datetime] = Query(None, description="Keyset cursor: return emails received before this time"),
+    before_id: Optional[str] = Query(None, description="Keyset cursor tie-breaker: id of the last email on the previous page"),
 ):
-    filter_dict: Dict[str, Any] = {"is_deleted": {"$ne": True}}
+    # Equality (not $ne) so the partial "mailbox_live" index can be used
+    filter_dict: Dict[str, Any] = {"is_deleted": False}
     if folder:
         filter_dict["folder"] = folder
     if tag:
         filter_dict["tags"] = tag
     if is_read is not None:
         filter_dict["is_read"] = is_read
-    if q:
-        filter_dict["$or"] = [
-            {"subject": {"$regex": q, "$options": "i"}},
-            {"sender": {"$regex": q, "$options": "i"}},
-            {"preview": {"$regex": q, "$options": "i"}},
-        ]
-
-    cursor = db["email"].find(filter_dict).sort("received_at", -1).skip((page - 1) * limit).limit(limit)
-    items = [serialize_doc(d) for d in cursor]
-    return {"items": items, "page": page, "limit": limit}
+    if before is not None:
+        if before_id is not None:
+            # (received_at, _id) cursor so emails sharing the boundary timestamp aren't skipped
+            boundary_id = parse_object_ids([before_id])[0]
+            # Under $and so it can't collide with the search filter's own $or
+            filter_dict["$and"] = [{"$or": [
+                {"received_at": {"$lt": before}},
+                {"received_at": before, "_id": {"$lt": boundary_id}},
+            ]}]
+        else:
+            filter_dict["received_at"] = {"$lt": before}
+
+    def find_page(search: Dict[str, Any], ranked: bool):
+        projection = dict(_EMAIL_LIST_PROJECTION)
+        sort: List[Any] = [("received_at", DESCENDING), ("_id", DESCENDING)]
+        if ranked:
+            projection["score"] = {"$meta": "textScore"}
+            # Rank by relevance; received_at only breaks ties
+            sort = [("score", {"$meta": "textScore"}), ("received_at", DESCENDING), ("_id", DESCENDING)]
+        cursor = db["email"].find({**filter_dict, **search}, projection).sort(sort)
+        # The received_at keyset cursor only applies to time-ordered results
+        if before is None or ranked:
+            cursor = cursor.skip((page - 1) * limit)
+        return cursor.limit(limit)
+
+    ranked = bool(q) and _TEXT_QUERY_RE.fullmatch(q) is not None
+    if ranked:
+        search: Dict[str, Any] = {"$text": {"$search": q}}
+    else:
+        search = _build_q_filter(q) if q else {}
+    cursor = find_page(search, ranked)
+    # Cursors are lazy: pull the first document before the 200 goes out so
+    # query errors still surface as a proper error response
+    first = await anext(cursor, None)
+    if first is None and ranked and (
+        page == 1 or await db["email"].find_one({**filter_dict, **search}, {"_id": 1}) is None
+    ):
+        # $text only matches whole (stemmed) words; when it finds nothing at all,
+        # retry as a prefix search so partial words like "inv" still match "invoice"
+        ranked = False
+        cursor = find_page(_build_q_filter(q), ranked)
+        first = await anext(cursor, None)
+
+    async def stream():
+        # Encode and send one document at a time instead of building the page in memory
+        yield b'{"items":['
+        count = 0
+        last = None
+        if first is not None:
+            last = serialize_email(first)
+            yield dumps(last)
+            count = 1
+            async for d in cursor:
+                last = serialize_email(d)
+                yield b"," + dumps(last)
+                count += 1
+        next_before = next_before_id = None
+        if last is not None and count == limit and not ranked:
+            next_before, next_before_id = last.get("received_at"), last["id"]
+        yield b'],"page":%d,"limit":%d,"next_before":%s,"next_before_id":%s}' % (
+            page, limit, dumps(next_before), dumps(next_before_id),
+        )
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 
 @app.post("/api/emails")
 async def create_email(payload: EmailCreate):
     data = payload.model_dump()
-    if not data.get("preview") and data.get("body"):
-        data["preview"] = (data["body"] or "")[:140]
-    if not data.get("received_at"):
-        data["received_at"] = datetime.now(timezone.utc)
-    inserted_id = create_document("email", data)
-    doc = db["email"].find_one({"_id": ObjectId(inserted_id)})
-    serialized = serialize_doc(doc)
+    # Denormalize at write time so the read path can assume every field is present.
+    # Explicit flags also keep new emails inside the partial mailbox index.
+    data["is_archived"] = False
+    data["is_deleted"] = False
+    data["preview"] = data["preview"] or (data["body"] or "")[:140]
+    data["received_at"] = datetime.now(timezone.utc)
+    data["subject_lc"] = data["subject"].lower()
+    data["sender_lc"] = data["sender"].lower()
+    data["preview_lc"] = data["preview"].lower()
+    data["has_tags"] = len(data["tags"]) > 0
+    # The inserted document is already in hand; no need to read it back
+    doc = await insert_document("email", data)
+    for field in _EMAIL_SHADOW_FIELDS:
+        doc.pop(field, None)
+    serialized = serialize_email(doc)
     await broadcast({"type": "email_created", "email": serialized})
-    return {"id": inserted_id, "email": serialized}
+    return {"id": serialized["id"], "email": serialized}
 
 
 class BulkAction(BaseModel):
@@ -203,51 +455,78 @@ class BulkAction(BaseModel):
     tag: Optional[str] = None
 
 
+# Maps each bulk action to its write ops for the selected emails; None means the payload is incomplete
+BULK_ACTIONS: Dict[str, Callable[[BulkAction, Dict[str, Any]], Optional[List[UpdateMany]]]] = {
+    "archive": lambda p, f: [UpdateMany(f, {"$set": {"is_archived": True, "folder": "archive"}})],
+    "delete": lambda p, f: [UpdateMany(f, {"$set": {"is_deleted": True, "folder": "trash"}})],
+    "mark_read": lambda p, f: [UpdateMany(f, {"$set": {"is_read": True}})],
+    "mark_unread": lambda p, f: [UpdateMany(f, {"$set": {"is_read": False}})],
+    "move_folder": lambda p, f: [UpdateMany(f, {"$set": {"folder": p.folder}})] if p.folder else None,
+    "add_tag": lambda p, f: [
+        UpdateMany(f, {"$addToSet": {"tags": p.tag}, "$set": {"has_tags": True}}),
+    ] if p.tag else None,
+    # Emails whose only tag is being removed also clear has_tags; the second op then
+    # pulls the tag from the rest. Each email is modified by exactly one op.
+    "remove_tag": lambda p, f: [
+        UpdateMany(
+            {**f, "tags": {"$all": [p.tag], "$not": {"$elemMatch": {"$ne": p.tag}}}},
+            {"$pull": {"tags": p.tag}, "$set": {"has_tags": False}},
+        ),
+        UpdateMany({**f, "tags": p.tag}, {"$pull": {"tags": p.tag}}),
+    ] if p.tag else None,
+}
+
+
 @app.patch("/api/emails/bulk")
 async def bulk_update(payload: BulkAction):
-    ids = [to_object_id(i) for i in payload.ids]
+    ids = parse_object_ids(payload.ids)
     filt = {"_id": {"$in": ids}}
 
-    update: Dict[str, Any] = {}
-    if payload.action == "archive":
-        update = {"$set": {"is_archived": True, "folder": "archive"}}
-    elif payload.action == "delete":
-        update = {"$set": {"is_deleted": True, "folder": "trash"}}
-    elif payload.action == "mark_read":
-        update = {"$set": {"is_read": True}}
-    elif payload.action == "mark_unread":
-        update = {"$set": {"is_read": False}}
-    elif payload.action == "move_folder" and payload.folder:
-        update = {"$set": {"folder": payload.folder}}
-    elif payload.action == "add_tag" and payload.tag:
-        update = {"$addToSet": {"tags": payload.tag}}
-    elif payload.action == "remove_tag" and payload.tag:
-        update = {"$pull": {"tags": payload.tag}}
-    else:
+    op = BULK_ACTIONS.get(payload.action)
+    ops = op(payload, filt) if op else None
+    if ops is None:
         return {"updated": 0, "message": "No valid action provided"}
 
-    result = db["email"].update_many(filt, update)
-    await broadcast({"type": "emails_updated", "action": payload.action, "count": result.modified_count})
+    # One bulk_write round trip; ordered only when an action's ops depend on each other
+    emails = db["email"].with_options(write_concern=WriteConcern(w=1, j=False))
+    result = await emails.bulk_write(ops, ordered=len(ops) > 1)
+    _broadcast_queue.put_nowait({"type": "emails_updated", "action": payload.action, "count": result.modified_count})
     return {"updated": result.modified_count}
 
 
 # ---------------------------
 # Tags & Folders
 # ---------------------------
+# Rarely-changing collections are served from pre-encoded bytes, keyed by a
+# version that the create endpoints bump. The cache is per process.
+_collection_versions: Dict[str, int] = {"tag": 0, "folder": 0}
+_collection_cache: Dict[str, Tuple[int, bytes]] = {}
+
+
+async def cached_collection_response(collection_name: str) -> Response:
+    version = _collection_versions[collection_name]
+    cached = _collection_cache.get(collection_name)
+    if cached is None or cached[0] != version:
+        docs = await get_documents(collection_name)
+        cached = (version, dumps([serialize_doc(d) for d in docs]))
+        _collection_cache[collection_name] = cached
+    return Response(content=cached[1], media_type="application/json")
+
+
 class TagCreate(BaseModel):
     name: str
     color: str = "#60a5fa"
 
 
 @app.get("/api/tags")
-def list_tags():
-    docs = get_documents("tag")
-    return [serialize_doc(d) for d in docs]
+async def list_tags():
+    return await cached_collection_response("tag")
 
 
 @app.post("/api/tags")
-def create_tag(payload: TagCreate):
-    tag_id = create_document("tag", payload)
+async def create_tag(payload: TagCreate):
+    tag_id = await create_document("tag", payload)
+    _collection_versions["tag"] += 1
     return {"id": tag_id}
 
 
@@ -257,14 +536,14 @@ class FolderCreate(BaseModel):
 
 
 @app.get("/api/folders")
-def list_folders():
-    docs = get_documents("folder")
-    return [serialize_doc(d) for d in docs]
+async def list_folders():
+    return await cached_collection_response("folder")
 
 
 @app.post("/api/folders")
-def create_folder(payload: FolderCreate):
-    folder_id = create_document("folder", payload)
+async def create_folder(payload: FolderCreate):
+    folder_id = await create_document("folder", payload)
+    _collection_versions["folder"] += 1
     return {"id": folder_id}
 
 
@@ -279,14 +558,14 @@ class EventCreate(BaseModel):
 
 
 @app.get("/api/events")
-def list_events(limit: int = 20):
-    docs = db["event"].find({}).sort("starts_at", -1).limit(limit)
+async def list_events(limit: int = 20):
+    docs = await db["event"].find({}).sort("starts_at", -1).limit(limit).to_list(length=limit)
     return [serialize_doc(d) for d in docs]
 
 
 @app.post("/api/events")
-def create_event(payload: EventCreate):
-    event_id = create_document("event", payload)
+async def create_event(payload: EventCreate):
+    event_id = await create_document("event", payload)
     return {"id": event_id}
 
 